@@ -9,8 +9,6 @@ import os
 import pathlib
 import sys
 
-from PyQt5.QtWidgets import QApplication
-
 from src.cmdWorker import access_handler
 from src.config import config_exists, document_folder, make_default, validate_config
 from src.logger import actionLogger, logException
@@ -32,6 +30,20 @@ def saveCurrentFolder():
         f.write(os.path.dirname(os.path.abspath(__file__)))
 
 
+def hideOwnConsole():
+    """Hide the console window PyWall was given, unless it is shared with a terminal."""
+    if sys.platform != "win32":
+        return
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    # A terminal the user started PyWall from also lists its own process here
+    if kernel32.GetConsoleProcessList((ctypes.c_uint * 2)(), 2) != 1:
+        return
+    hwnd = kernel32.GetConsoleWindow()
+    if hwnd:
+        ctypes.windll.user32.ShowWindow(hwnd, 0)  # SW_HIDE
+
+
 def main():
     """Main entry point for PyWall."""
     # Verify config file
@@ -73,6 +85,8 @@ def main():
             argument = str(args.c)
             # Access handling
             if "allowAccess" in argument or "denyAccess" in argument:
+                # Context menu runs are launched elevated with a visible window, don't leave a console up
+                hideOwnConsole()
                 print(all_args)
                 arg = all_args[1]
                 file_path = arg[0]
@@ -96,7 +110,7 @@ def main():
 
         if args.install:
             actionLogger("Installing context menu")
-            createInternetAccessMenu()
+            createInternetAccessMenu(force=True)
             return
 
         if args.uninstall:
@@ -129,7 +143,8 @@ def main():
         raise critical
     # Launch GUI if no command line arguments are provided
     try:
-        # Import and start the GUI
+        # Qt is only imported here, command line and context menu runs never need it
+        from PyQt5.QtWidgets import QApplication
         from src.configGui import start
         app = QApplication(sys.argv)
         try:
@@ -4,17 +4,22 @@ cmdWorker module for handling firewall rules.
 
 import subprocess
 import os
+import re
 import sys
 import ctypes
 import pathlib
+from functools import lru_cache
+from itertools import chain, islice
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from src.pop import toastNotification, infoMessage, icons
 from src.logger import actionLogger, logException
 from src.config import get_config, config_file
 
-ignoredFiles = get_config("FILETYPE", "blacklisted_names").split(",")
-
 
+@lru_cache(maxsize=1)
 def admin():
+    # Elevation can't change during the lifetime of the process
     try:
         is_admin = os.getuid() == 0
     except AttributeError:
@@ -76,31 +81,316 @@ def get_allowed_types():
     return [t.strip() for t in allowed_types_str.split(",")]
 
 
-allowedTypes = get_allowed_types()
-
-
-def path_foreach_in(path):  # A rather telling name, isn't?
-    from glob import glob
-    glob_pattern = os.path.join(path, '*')
-    filesNoRecursive = sorted(glob(glob_pattern), key=os.path.getctime)
-    if get_config("FILETYPE", "recursive") == "True":
-        filesRecursive = sorted(
-            glob(glob_pattern + r"/**", recursive=True), key=os.path.getctime)
-        files = sorted(filesRecursive + filesNoRecursive, key=os.path.getctime)
-    elif get_config("FILETYPE", "recursive") == "False":
-        files = filesNoRecursive
-    else:
+def get_recursive():
+    recursive = get_config("FILETYPE", "recursive")
+    if recursive not in {"True", "False"}:
         from src.config import modify_config
         modify_config("FILETYPE", "recursive", "True")
-        filesRecursive = sorted(
-            glob(glob_pattern + r"/**", recursive=True), key=os.path.getctime)
-        files = sorted(filesRecursive + filesNoRecursive, key=os.path.getctime)
-    return files
+        recursive = "True"
+    return recursive == "True"
 
 
-def access_handler(path, action, rule_type: str):
-    allFiles = None
+@dataclass(frozen=True)
+class _Settings:
+    """Config values used while gathering files, read once instead of on every call."""
+    recursive: bool
+    allowed_suffixes: frozenset
+    ignored_stems: frozenset
+
+
+def _load_settings():
+    ignored_files = get_config("FILETYPE", "blacklisted_names").split(",")
+    return _Settings(
+        recursive=get_recursive(),
+        # Normalised once so filtering is a hash lookup instead of a substring scan per type
+        allowed_suffixes=frozenset(
+            "." + t.lower().lstrip(".") for t in get_allowed_types() if t.lstrip(".")),
+        ignored_stems=frozenset(s.strip() for s in ignored_files if s.strip())
+    )
+
+
+_settings = _load_settings()
+
+
+def reload_settings():
+    """Re-read the cached settings, to be called after the config file changes."""
+    global _settings
+    _settings = _load_settings()
+
+
+def _walk(path):
+    """Yield the DirEntry of everything under path as it is discovered."""
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                yield entry
+                if _settings.recursive and entry.is_dir(follow_symlinks=False):
+                    yield from _walk(entry.path)
+    except PermissionError:
+        actionLogger(f'Skipping "{path}", access denied')
+    except OSError as error:
+        # A folder removed mid-scan, a broken junction or a dropped share only loses that folder,
+        # part of the rules may already be applied by the time the walk gets here
+        actionLogger(f'Skipping "{path}": {error}')
+
+
+def _is_valid_target(p: pathlib.Path) -> bool:
+    # Cheap set lookups first, the is_file() stat only runs for candidates
+    return (p.suffix.lower() in _settings.allowed_suffixes
+            and p.stem not in _settings.ignored_stems
+            and p.is_file())
+
+
+def _is_valid_entry(entry: os.DirEntry) -> bool:
+    # Same checks on the scandir entry, whose is_file() needs no extra stat on Windows
+    stem, suffix = os.path.splitext(entry.name)
+    return (suffix.lower() in _settings.allowed_suffixes
+            and stem not in _settings.ignored_stems
+            and entry.is_file())
+
+
+def _gather_target_files(path: pathlib.Path):
+    """
+    Lazily yield the files PyWall should act on, so work can start while a folder is still
+    being scanned. Reports through path_error and returns None when there are none.
+    """
+    if not _settings.allowed_suffixes:
+        # Nothing could ever match, don't walk the folder just to find that out
+        actionLogger("No accepted filetypes are configured")
+        path_error(path)
+        return None
+
+    allFiles = iter(())
+    try:
+        if path.is_dir():
+            actionLogger("Folder detected, proceeding accordingly")
+            # Only entries that pass are turned into a Path
+            allFiles = (pathlib.Path(e.path) for e in _walk(path) if _is_valid_entry(e))
+        elif _is_valid_target(path):
+            actionLogger("File detected, proceeding accordingly")
+            allFiles = iter([path])
+        first = next(allFiles, None)
+    except OSError:
+        path_error(path)
+        return None
+
+    if first is None:
+        path_error(path)
+        return None
+    return chain([first], allFiles)
+
+
+_RULE_NAME_PREFIX = "PyWall blocked "
+# Only the rule name, direction and program vary per rule
+_RULE_PREFIX = {
+    "deny": ("netsh", "advfirewall", "firewall", "add", "rule"),
+    "allow": ("netsh", "advfirewall", "firewall", "delete", "rule")
+}
+_RULE_SUFFIX = {
+    "deny": ("action=block",),
+    "allow": ()
+}
+
+
+def _build_firewall_command(action, direction, program: pathlib.Path):
+    return [
+        *_RULE_PREFIX[action], f"name={_RULE_NAME_PREFIX}{program.stem}",
+        f"dir={direction}", f"program={program}", *_RULE_SUFFIX[action]
+    ]
+
+
+_PLAIN_VALUE_RE = re.compile(r"\w+")
+
+
+def _session_line(argv):
+    # Values that aren't plain words are always quoted, so spaces, "&" or "^" in a path
+    # aren't interpreted by cmd.exe. Quoting doesn't stop %NAME% expansion, which is why
+    # commands containing "%" never go through the session
+    parts = []
+    for arg in argv:
+        key, sep, value = arg.partition("=")
+        if sep and not _PLAIN_VALUE_RE.fullmatch(value):
+            arg = f'{key}="{value}"'
+        parts.append(arg)
+    return " ".join(parts)
+
+
+_START = "__PYWALL_START_"
+_SENTINEL = "__PYWALL_DONE_"
+# A command's output sits between its start marker and the sentinel carrying its errorlevel
+_SENTINEL_RE = re.compile(
+    _START + r"(\d+)__(.*?)" + _SENTINEL + r"\1_(-?\d+)__", re.DOTALL)
+
+
+def _log_failure(program, returncode, output):
+    # netsh prints its errors on stdout, they're only worth keeping when the command failed
+    message = f'Command failed for "{program}" with exit code {returncode}'
+    output = output.strip()
+    actionLogger(f"{message}: {output}" if output else message)
+
+
+def _execute_direct(argv):
+    """Run a single command without cmd.exe, returning its exit code and output."""
+    try:
+        result = subprocess.run(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding="oem",
+            errors="replace"
+        )
+    except OSError as error:
+        return -1, f"Unable to run netsh: {error}"
+    return result.returncode, result.stdout
+
+
+def _execute_firewall_commands(commands):
+    """
+    Run every (program, argv) pair through a single cmd.exe session fed over stdin,
+    instead of paying a cmd.exe + netsh startup per rule.
+    Returns the programs whose command failed.
+    """
+    failed = []
+    session = []
+    for program, argv in commands:
+        if any("%" in arg for arg in argv):
+            # cmd.exe would expand %NAME% in the path, so these are run on their own
+            actionLogger(f"Executing command: {subprocess.list2cmdline(argv)}")
+            returncode, output = _execute_direct(argv)
+            if returncode != 0:
+                _log_failure(program, returncode, output)
+                if program not in failed:
+                    failed.append(program)
+        else:
+            session.append((program, argv))
+    for program in _execute_session(session):
+        if program not in failed:
+            failed.append(program)
+    return failed
+
+
+def _execute_session(commands):
+    if not commands:
+        return []
+    # Each command is wrapped in a start marker and a sentinel carrying its errorlevel, so
+    # failures and netsh's error text can be mapped back to the file that caused them
+    script = ["@echo off", "chcp 65001 >nul"]
+    for index, (_, argv) in enumerate(commands):
+        command = _session_line(argv)
+        actionLogger(f"Executing command: {command}")
+        script.append(f"echo {_START}{index}__")
+        # netsh gets no stdin, otherwise it would inherit the pipe holding the rest of the script
+        script.append(command + " <nul 2>&1")
+        script.append(f"echo {_SENTINEL}{index}_%errorlevel%__")
+    script.append("exit")
+
+    # /D keeps the user's Command Processor AutoRun hooks out of the session and its output
+    proc = subprocess.Popen(
+        ["cmd.exe", "/D", "/Q", "/K"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        errors="replace"
+    )
+    stdout, stderr = proc.communicate("\n".join(script) + "\n")
+
+    failed = []
+    finished = set()
+    for match in _SENTINEL_RE.finditer(stdout):
+        index = int(match.group(1))
+        finished.add(index)
+        if match.group(3) != "0":
+            program = commands[index][0]
+            _log_failure(program, match.group(3), match.group(2))
+            if program not in failed:
+                failed.append(program)
+
+    # Anything that never reported back (e.g. the session died) is treated as failed
+    for index, (program, _) in enumerate(commands):
+        if index not in finished and program not in failed:
+            failed.append(program)
+    if stderr.strip():
+        actionLogger(stderr.strip())
+    return failed
+
+
+# Large folders are split into several cmd.exe sessions that run side by side,
+# netsh spends most of its time waiting on the firewall service
+_BATCH_SIZE = 64
+_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+def _execute_in_batches(commands):
+    """Consume the commands iterable batch by batch, returning the programs that failed."""
+    commands = iter(commands)
+    batches = iter(lambda: list(islice(commands, _BATCH_SIZE)), [])
+    first = next(batches, [])
+    second = next(batches, None)
+    if second is None:
+        return _execute_firewall_commands(first)
+
+    failed = []
+    pending = set()
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        for batch in chain([first, second], batches):
+            # Only keep a bounded number of batches in flight, the rest of the folder
+            # isn't scanned until a session frees up
+            if len(pending) >= _MAX_WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    failed.extend(future.result())
+            pending.add(executor.submit(_execute_firewall_commands, batch))
+    for future in pending:
+        failed.extend(future.result())
+    # A file blocked in both directions may fail in two different batches
+    return list(dict.fromkeys(failed))
+
+
+def _existing_pywall_rules(name="all", directions=("in", "out")):
+    """
+    Map each direction to the names of the PyWall rules currently present, so allowing
+    doesn't ask netsh to delete rules that were never added, which it reports as a failure.
+    A single file only looks up its own rule name instead of listing the whole rule set.
+    Returns None if the rule set couldn't be read.
+    """
+    existing = {}
+    for direction in directions:
+        try:
+            result = subprocess.run(
+                ["netsh", "advfirewall", "firewall", "show", "rule", f"name={name}", f"dir={direction}"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                encoding="oem",
+                errors="replace"
+            )
+        except OSError as error:
+            actionLogger(f"Unable to list firewall rules: {error}")
+            return None
+        if result.returncode != 0:
+            if name == "all":
+                return None
+            # "No rules match the specified criteria." is how netsh reports a missing named rule
+            existing[direction] = frozenset()
+            continue
+        # Only the rule name line contains the prefix, which keeps this independent of
+        # the language netsh labels its fields in
+        existing[direction] = frozenset(
+            line[line.index(_RULE_NAME_PREFIX):].strip()
+            for line in result.stdout.splitlines() if _RULE_NAME_PREFIX in line
+        )
+    return existing
+
 
+def _rule_exists(existing, program: pathlib.Path, direction):
+    rule_name = _RULE_NAME_PREFIX + program.stem
+    # Names that don't survive netsh's console code page are always sent to be deleted
+    return existing is None or not rule_name.isascii() or rule_name in existing[direction]
+
+
+def access_handler(path, action, rule_type: str):
     if rule_type not in {"both", "in", "out"}:
         from src.shellHandler import pop
         pop(
@@ -109,106 +399,79 @@ def access_handler(path, action, rule_type: str):
             True
         )
         return
+    if action not in _RULE_PREFIX:
+        return "Invalid action"
 
-    try:
-        path = pathlib.Path(str(path).strip())
-        is_dir = path.is_dir()
-        is_file = path.is_file()
-        if is_dir:
-            actionLogger("Folder detected, proceeding accordingly")
-            allFiles = [
-                pathlib.Path(y) for y in path_foreach_in(path)
-                if any(z in pathlib.Path(y).suffix for z in allowedTypes)
-                and pathlib.Path(y).stem not in ignoredFiles
-            ]
-        elif is_file:
-            actionLogger("File detected, proceeding accordingly")
-            if pathlib.Path(path).stem not in ignoredFiles:
-                if any(z in pathlib.Path(path).suffix for z in allowedTypes):
-                    allFiles = [path]
-    except OSError:
-        path_error(path)
+    path = pathlib.Path(str(path).strip())
+    allFiles = _gather_target_files(path)
+    if allFiles is None:
         return
 
-    if not allFiles:
-        path_error(path)
-        return
+    directions = ("out", "in") if rule_type == "both" else (rule_type,)
+    cmn = "blocked" if action == "deny" else "allowed"
 
     try:
-        for y in allFiles:
-            p = pathlib.Path(y)
-            command = False
-            if action == "deny":
-                cmn = "blocked"
-                if rule_type != "both":
-                    command = (
-                        f'@echo off && netsh advfirewall firewall add rule name="PyWall blocked {str(p.stem)}" '
-                        f'dir={rule_type} program="{p}" action=block'
-                    )
-            else:
-                cmn = "allowed"
-                if rule_type != "both":
-                    command = (
-                        f'@echo off && netsh advfirewall firewall delete rule name="PyWall blocked {str(p.stem)}" '
-                        f'dir={rule_type} program="{p}"'
-                    )
-
-            if admin():
-                if not command and action == "allow":
-                    first_command = (
-                        f'@echo off && netsh advfirewall firewall delete rule name="PyWall blocked '
-                        f'{str(p.stem)}" dir=out program="{p}"'
-                    )
-                    second_command = (
-                        f'@echo off && netsh advfirewall firewall delete rule name="PyWall blocked '
-                        f'{str(p.stem)}" dir=in program="{p}"'
-                    )
-                    subprocess.call(f'cmd /c {first_command}', shell=True)
-                    subprocess.call(f'cmd /c {second_command}', shell=True)
-                elif not command and action == "deny":
-                    first_command = (
-                        f'@echo off && netsh advfirewall firewall add rule name="PyWall blocked '
-                        f'{str(p.stem)}" dir=out program="{p}" action=block'
-                    )
-                    second_command = (
-                        f'@echo off && netsh advfirewall firewall add rule name="PyWall blocked '
-                        f'{str(p.stem)}" dir=in program="{p}" action=block'
-                    )
-                    subprocess.call(f'cmd /c {first_command}', shell=True)
-                    subprocess.call(f'cmd /c {second_command}', shell=True)
-                else:
-                    subprocess.call(f'cmd /c {command}', shell=True)
-                actionLogger(f"Successfully {cmn} {str(p.stem)}")
-            else:
-                try:
-                    icon = icons("critical")
-                    infoMessage(
-                        "Not Admin",
-                        "Missing UAC privileges",
-                        "This task requires elevation, please run as Admin",
-                        icon
-                    )
-                except NameError:
-                    actionLogger("Commands detected, skipping infoMessage")
-                    pass
-                # Fixed bug: Changed from "".join(sys.argv) to " ".join(sys.argv)
-                args = " ".join(sys.argv)
-                ctypes.windll.shell32.ShellExecuteW(None, "runas", sys.executable, args, None, 1)
-                sys.exit("Admin re-run")
+        if not admin():
+            try:
+                icon = icons("critical")
+                infoMessage(
+                    "Not Admin",
+                    "Missing UAC privileges",
+                    "This task requires elevation, please run as Admin",
+                    icon
+                )
+            except NameError:
+                actionLogger("Commands detected, skipping infoMessage")
+                pass
+            # A frozen build is its own executable, from source main.py has to be passed along.
+            # list2cmdline keeps arguments containing spaces intact
+            relaunch_args = sys.argv[1:] if getattr(sys, "frozen", False) else sys.argv
+            args = subprocess.list2cmdline([str(arg) for arg in relaunch_args])
+            ctypes.windll.shell32.ShellExecuteW(None, "runas", sys.executable, args, None, 1)
+            sys.exit("Admin re-run")
+
+        if action != "allow":
+            existing = None
+        elif path.is_dir():
+            existing = _existing_pywall_rules()
+        else:
+            # Listing the whole rule set only pays off for a folder, a file looks up its own rule
+            existing = _existing_pywall_rules(_RULE_NAME_PREFIX + path.stem, directions)
+        total = 0
+
+        def commands():
+            nonlocal total
+            for p in allFiles:
+                total += 1
+                for direction in directions:
+                    if _rule_exists(existing, p, direction):
+                        yield p, _build_firewall_command(action, direction, p)
+
+        failed = _execute_in_batches(commands())
+        actionLogger(f"Successfully {cmn} {total - len(failed)} of {total} files")
 
     except Exception as argument:
         logException(argument)  # Fixed: Changed from Argument to argument
         raise
 
+    # Failures are reported in a single toast rather than one per file
+    if failed:
+        toastNotification(
+            "Partial failure",
+            f'{len(failed)} of {total} files could not be {cmn} in\n"{path.name}"'
+        )
+        return
     if action == "deny":
         toastNotification(
             "Success", f'Internet access successfully denied to\n"{path}"')
-    elif action == "allow":
+    else:
         toastNotification(
             "Success", f'Internet access successfully allowed to\n"{path}"')
-    else:
-        return "Invalid action"
 
 
 def open_config():
-    subprocess.call(f'cmd /c @echo off && {config_file()}')
+    # ShellExecute through os.startfile opens the file with its associated editor directly
+    try:
+        os.startfile(config_file())
+    except OSError as error:
+        logException("open_config_error", error)
@@ -5,12 +5,21 @@ Module for handling configuration settings for PyWall.
 import pathlib
 import sys
 import os
-import configparser
+import hashlib
+import locale
+import shutil
 import ctypes.wintypes
+import struct
+import threading
+import time
+from functools import lru_cache
 from src.logging_utils import action_logger
 
-PYWALL_INI = "\\PyWall\\Config.ini"
-PYWALL = "\\PyWall"
+# Relative to the user's Documents folder
+_CFG_DIR = pathlib.Path("PyWall")
+_CFG_NAME = "Config.ini"
+_REPLACE_ATTEMPTS = 5
+_REPLACE_DELAY = 0.05
 
 default_config = {
     "FILETYPE": {
@@ -35,9 +44,23 @@ default_config = {
 }
 
 
+def _config_triples(config_dict):
+    return tuple(
+        (section, option, value)
+        for section, options in config_dict.items()
+        for option, value in options.items()
+    )
+
+
+# Flattened once, validate_config walks this on every start
+_DEFAULT_TRIPLES = _config_triples(default_config)
+
+
+@lru_cache(maxsize=1)
 def document_folder():
     """
     Get the path to the user's document folder.
+    The shell lookup only runs once per process.
     """
     CSIDL_PERSONAL = 5  # My Documents
     SHGFP_TYPE_CURRENT = 0  # Get current value, not default
@@ -56,48 +79,277 @@ def script_folder():
     return os.path.abspath(".")
 
 
+@lru_cache(maxsize=1)
+def _config_path():
+    # Joining a rooted "\\PyWall\\Config.ini" dropped the Documents folder on Windows
+    return str(pathlib.Path(document_folder()) / _CFG_DIR / _CFG_NAME)
+
+
+def _stat_or_none(path):
+    # One stat answers both "does it exist" and "when was it modified"
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _stat_config():
+    """
+    Stat the configuration file, creating the default one if it's missing.
+    """
+    path = _config_path()
+    stat = _stat_or_none(path)
+    if stat is None:
+        make_default()
+        stat = os.stat(path)
+    return stat
+
+
 def config_file():
     """
     Get the configuration file path.
     """
-    document_folder_path = document_folder()
-    config_path = os.path.join(document_folder_path, PYWALL_INI)
-    if os.path.exists(config_path):
+    config_path = _config_path()
+    if _stat_or_none(config_path) is not None:
         return config_path
     make_default()
     return config_path
 
 
+def _read_ini_bytes(path):
+    """
+    Read a whole file with one read call, returning its bytes and the stat of the open handle.
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        stat = os.fstat(fd)
+        data = os.read(fd, stat.st_size)
+        # A short read only happens if the file grew in between, pick up the rest
+        while len(data) < stat.st_size:
+            chunk = os.read(fd, stat.st_size - len(data))
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        os.close(fd)
+    return data, stat
+
+
+def _decode_config(data):
+    """
+    Decode the config file, which PyWall writes as UTF-8 (with or without a BOM).
+    Files saved in the ANSI code page by older versions or other editors are still read,
+    so a stray byte never makes the config look malformed and get reset.
+    """
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode(locale.getpreferredencoding(False), errors='replace')
+
+
+def read_config_text():
+    """
+    Get the contents of the configuration file as text.
+    """
+    # Newlines as a text-mode read would give them, for comparing against editor contents
+    return _decode_config(_read_ini_bytes(config_file())[0]).replace('\r\n', '\n')
+
+
+def _parse_ini(text):
+    """
+    Parse the flat key = value layout PyWall writes into {section: {option: value}}.
+    Raises ValueError for anything else, such as continuation lines or ':' delimiters.
+    """
+    config = {}
+    options = None
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if not stripped or stripped[0] in "#;":
+            continue
+        if line[0] in " \t":
+            raise ValueError("Continuation lines are not supported")
+        if stripped[0] == "[" and stripped[-1] == "]":
+            section = stripped[1:-1]
+            if section in config:
+                raise ValueError(f"Duplicate section '{section}'")
+            options = config[section] = {}
+            continue
+        delimiter = stripped.find("=")
+        if delimiter <= 0 or options is None:
+            raise ValueError(f"Unexpected line '{stripped}'")
+        # Options are case insensitive, stored lowercase like ConfigParser does
+        option = stripped[:delimiter].rstrip().lower()
+        if option in options:
+            raise ValueError(f"Duplicate option '{option}'")
+        options[option] = stripped[delimiter + 1:].lstrip()
+    return config
+
+
+def _parse_ini_fallback(text):
+    """
+    Parse a file _parse_ini rejects with ConfigParser, raising ValueError if that fails too.
+    """
+    import configparser
+    # No interpolation or inline comments, PyWall's values are plain strings
+    parser = configparser.RawConfigParser(
+        interpolation=None, inline_comment_prefixes=None, empty_lines_in_values=False)
+    try:
+        parser.read_string(text)
+    except configparser.Error as e:
+        raise ValueError(str(e)) from e
+    return {section: dict(parser.items(section)) for section in parser.sections()}
+
+
+def _format_ini(config):
+    return "".join(
+        f"[{section}]\n" + "".join(f"{option} = {value}\n" for option, value in options.items()) + "\n"
+        for section, options in config.items()
+    )
+
+
+def _replace_file(tmp_path, path):
+    # Editors, antivirus and the indexer briefly open the file without FILE_SHARE_DELETE, which
+    # makes os.replace fail with a PermissionError until they let go of it
+    for attempt in range(_REPLACE_ATTEMPTS):
+        try:
+            os.replace(tmp_path, path)
+            return
+        except PermissionError:
+            if attempt == _REPLACE_ATTEMPTS - 1:
+                raise
+            time.sleep(_REPLACE_DELAY)
+
+
+def _replace_with(path, config):
+    """
+    Write a configuration next to path and swap it in, so readers never see a truncated file.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as configfile:
+            configfile.write(_format_ini(config))
+        _replace_file(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _legacy_config_path():
+    # Older versions joined "\\PyWall\\Config.ini" onto the Documents folder, which only kept its drive
+    return str(pathlib.Path(pathlib.Path(document_folder()).anchor) / _CFG_DIR / _CFG_NAME)
+
+
+def _migrate_legacy_config(config_path):
+    """
+    Copy the configuration from where older versions saved it.
+    Returns True if there was one to copy, the old file is left in place.
+    """
+    legacy_path = _legacy_config_path()
+    if legacy_path == config_path:
+        return False
+    tmp_path = config_path + ".tmp"
+    try:
+        shutil.copyfile(legacy_path, tmp_path)
+        _replace_file(tmp_path, config_path)
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        action_logger(f"Could not migrate configuration from {legacy_path}: {e}")
+        return False
+    action_logger(f"Configuration migrated from {legacy_path}")
+    return True
+
+
 def make_default():
     """
     Create the default configuration.
+    A configuration left at the legacy location is copied over instead.
     """
-    document_folder_path = document_folder()
-    config_folder = os.path.join(document_folder_path, PYWALL)
-    if not os.path.exists(config_folder):
-        os.makedirs(config_folder)
-    config_path = os.path.join(config_folder, "Config.ini")
-    config = configparser.ConfigParser()
-    for section, options in default_config.items():
-        config.add_section(section)
-        for option, value in options.items():
-            config.set(section, option, value)
-    with open(config_path, 'w', encoding='utf-8') as configfile:
-        config.write(configfile)
+    config_path = _config_path()
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    # Only a missing file is migrated, make_default also resets a malformed one
+    if _stat_or_none(config_path) is None and _migrate_legacy_config(config_path):
+        return
+    _replace_with(config_path, default_config)
     action_logger("Default configuration created")
 
 
+# Parsed config kept in memory, re-read only when the file's mtime changes
+_cached_config = None
+_cached_mtime = None
+_cached_path = None
+_cache_lock = threading.Lock()
+
+
+def _get_cached_config():
+    """
+    Get the parsed configuration, re-reading the file only when it has been modified.
+    """
+    global _cached_config, _cached_mtime, _cached_path
+    path = _config_path()
+    mtime = _stat_config().st_mtime_ns
+    with _cache_lock:
+        if _cached_config is None or path != _cached_path or mtime != _cached_mtime:
+            data, stat = _read_ini_bytes(path)
+            # Key the cache on the stat of what was actually read
+            mtime = stat.st_mtime_ns
+            text = _decode_config(data)
+            try:
+                config = _parse_ini(text)
+            except ValueError:
+                config = _parse_ini_fallback(text)
+            _cached_config, _cached_mtime, _cached_path = config, mtime, path
+        return _cached_config
+
+
+def _write_config(config):
+    """
+    Write a configuration to disk and keep it as the cached copy.
+    """
+    global _cached_config, _cached_mtime, _cached_path
+    path = _config_path()
+    with _cache_lock:
+        try:
+            _replace_with(path, config)
+        except OSError:
+            # The cached object may hold changes that never reached the disk
+            _cached_config = None
+            raise
+        # Recording the new mtime keeps the watcher and the next read from reloading our own write
+        _cached_config, _cached_mtime, _cached_path = config, os.stat(path).st_mtime_ns, path
+
+
+def _parse_list(value):
+    """
+    Split a comma separated config value into its stripped, non-empty items.
+    """
+    strip = str.strip
+    return [item for item in map(strip, value.split(",")) if item]
+
+
+# Parsed list values, keyed by option and checked against the raw value they came from
+_cached_lists = {}
+
+
+def _get_cached_list(config, section, variable):
+    value = config[section][variable]
+    cached = _cached_lists.get((section, variable))
+    if cached is None or cached[0] != value:
+        cached = _cached_lists[(section, variable)] = (value, tuple(_parse_list(value)))
+    return cached[1]
+
+
 def get_config(section, variable, *extra_args):
     """
     Get a configuration value.
     """
-    config = configparser.ConfigParser()
-    config.read(config_file())
+    config = _get_cached_config()
     if extra_args:
         index_value = ''.join(extra_args)
-        value = config[section][variable]
-        value_list = value.split(', ')
-        return value_list[int(index_value)]
+        return _get_cached_list(config, section, variable)[int(index_value)]
     return config[section][variable]
 
 
@@ -105,12 +357,10 @@ def modify_config(section, variable, value):
     """
     Modify a configuration value.
     """
-    config = configparser.ConfigParser()
-    config.read(config_file())
-    if config.has_option(section, variable):
-        config.set(section, variable, value)
-        with open(config_file(), 'w', encoding='utf-8') as configfile:
-            config.write(configfile)
+    config = _get_cached_config()
+    if variable in config.get(section, ()):
+        config[section][variable] = value
+        _write_config(config)
         action_logger(f"Variable '{variable}' modified in section '{section}'")
     else:
         action_logger(
@@ -121,23 +371,18 @@ def append_config(section, variable, value: list):
     """
     Append a value to a configuration list.
     """
-    config = configparser.ConfigParser()
-    config.read(config_file())
-    if config.has_option(section, variable):
-        current = config.get(section, variable)
-        # Clean up any trailing commas
-        current = current.rstrip(",")
-        # Split by comma and clean up each item
-        all_values = [item.strip()
-                      for item in current.split(",") if item.strip()]
+    config = _get_cached_config()
+    if variable in config.get(section, ()):
+        all_values = _parse_list(config[section][variable])
+        existing = set(all_values)
         for x in value:
-            if x not in all_values:
+            if x not in existing:
+                existing.add(x)
                 all_values.append(x)
         # Join with comma and space
         all_values = ", ".join(all_values)
-        config.set(section, variable, all_values)
-        with open(config_file(), 'w', encoding='utf-8') as configfile:
-            config.write(configfile)
+        config[section][variable] = all_values
+        _write_config(config)
         action_logger(
             f"Values '{value}' appended to variable '{variable}' in section '{section}'")
         return True
@@ -148,18 +393,13 @@ def remove_config(section, variable, value: list):
     """
     Remove a value from a configuration list.
     """
-    config = configparser.ConfigParser()
-    config.read(config_file())
-    if config.has_option(section, variable):
-        current = config.get(section, variable)
-        all_values = current.split(", ") if "," in current else [current]
-        for x in value:
-            if x in all_values:
-                all_values.remove(x)
-        all_values = ", ".join(all_values)
-        config.set(section, variable, all_values)
-        with open(config_file(), 'w', encoding='utf-8') as configfile:
-            config.write(configfile)
+    config = _get_cached_config()
+    if variable in config.get(section, ()):
+        all_values = _parse_list(config[section][variable])
+        to_remove = {str(x).strip() for x in value}
+        all_values = ", ".join(x for x in all_values if x not in to_remove)
+        config[section][variable] = all_values
+        _write_config(config)
         action_logger(
             f"Values '{value}' removed from variable '{variable}' in section '{section}'")
         return True
@@ -170,39 +410,82 @@ def config_exists():
     """
     Check if the configuration file exists.
     """
-    return os.path.exists(config_file())
+    return _stat_or_none(_config_path()) is not None
+
+
+def _validation_digest(path, triples):
+    """
+    Hash the config file together with the defaults it gets checked against.
+    """
+    digest = hashlib.blake2b(repr(triples).encode("utf-8"), digest_size=16)
+    digest.update(_read_ini_bytes(path)[0])
+    return digest.hexdigest()
+
+
+def _read_validated_marker(path):
+    try:
+        with open(path + ".validated", encoding='utf-8') as marker:
+            return marker.read().strip()
+    except OSError:
+        return None
+
+
+def _write_validated_marker(path, digest):
+    try:
+        with open(path + ".validated", 'w', encoding='utf-8') as marker:
+            marker.write(digest)
+    except OSError:
+        # Without the marker the next start simply validates again
+        pass
 
 
 def validate_config(default_file=None):
     """
     Validate the configuration file.
+    Missing options are restored from the defaults and the version is updated in memory,
+    so the file is written at most once.
     """
-    import time
-    config = configparser.ConfigParser()
-
     if default_file is None:
         default_file = default_config
 
     if config_exists():
+        path = _config_path()
+        triples = _DEFAULT_TRIPLES if default_file is default_config else _config_triples(default_file)
+        # An unchanged file that already passed against the same defaults needs no second sweep
+        if _read_validated_marker(path) == _validation_digest(path, triples):
+            action_logger("Configuration unchanged since last validation")
+            return True
+
         try:
-            config.read(config_file())
-        except configparser.ParsingError:
+            config = _get_cached_config()
+        except ValueError:
             make_default()
-            time.sleep(0.1)
+            config = _get_cached_config()
 
+        # Snapshot what the file has once, then check every default against it
+        existing = {section: set(options) for section, options in config.items()}
+        needs_save = False
         action_logger("-" * 50)
-        for x in range(len(default_file.keys())):
-            section = list(default_file.keys())[x]
-            for option in default_file[section]:
-                if config.has_option(section, option):
-                    action_logger(f'"{option}" validated')
-                else:
-                    action_logger(f'Check failed for "{option}"')
-                    action_logger("-" * 50)
-                    make_default()
+        for section, option, value in triples:
+            if section not in existing:
+                config[section] = {}
+                existing[section] = set()
+            if option in existing[section]:
+                action_logger(f'"{option}" validated')
+            else:
+                action_logger(f'Check failed for "{option}", restoring default')
+                config[section][option] = value
+                existing[section].add(option)
+                needs_save = True
         action_logger("-" * 50)
-        action_logger("Updating version")
-        modify_config("DEBUG", "version", default_file["DEBUG"]["version"])
+        version = default_file["DEBUG"]["version"]
+        if config["DEBUG"]["version"] != version:
+            action_logger("Updating version")
+            config["DEBUG"]["version"] = version
+            needs_save = True
+        if needs_save:
+            _write_config(config)
+        _write_validated_marker(path, _validation_digest(path, triples))
         action_logger("-" * 50)
         return True
 
@@ -210,29 +493,117 @@ def validate_config(default_file=None):
     return True
 
 
+# ReadDirectoryChangesW constants
+FILE_LIST_DIRECTORY = 0x0001
+FILE_SHARE_ALL = 0x0001 | 0x0002 | 0x0004
+OPEN_EXISTING = 3
+FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+FILE_NOTIFY_CHANGE_FILE_NAME = 0x0001
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x0010
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+
+def _wait_for_changes(folder, file_name, on_change):
+    """
+    Block on ReadDirectoryChangesW and call on_change whenever file_name is written or replaced.
+    Returns when the folder can't be watched, so the caller can fall back to polling.
+    """
+    try:
+        # A private instance, so the prototypes below don't change kernel32 for the rest of the process
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    except (AttributeError, OSError):
+        return
+    wintypes = ctypes.wintypes
+    kernel32.CreateFileW.argtypes = [
+        wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, ctypes.c_void_p,
+        wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+    kernel32.CreateFileW.restype = wintypes.HANDLE
+    kernel32.ReadDirectoryChangesW.argtypes = [
+        wintypes.HANDLE, ctypes.c_void_p, wintypes.DWORD, wintypes.BOOL, wintypes.DWORD,
+        ctypes.POINTER(wintypes.DWORD), ctypes.c_void_p, ctypes.c_void_p]
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+    handle = kernel32.CreateFileW(
+        folder, FILE_LIST_DIRECTORY, FILE_SHARE_ALL, None, OPEN_EXISTING,
+        FILE_FLAG_BACKUP_SEMANTICS, None)
+    if handle in (None, INVALID_HANDLE_VALUE):
+        return
+    buffer = ctypes.create_string_buffer(4096)
+    returned = wintypes.DWORD()
+    try:
+        # The thread sleeps in the kernel until something in the folder changes
+        while kernel32.ReadDirectoryChangesW(
+                handle, buffer, len(buffer), False,
+                FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_LAST_WRITE,
+                ctypes.byref(returned), None, None):
+            if returned.value == 0:
+                # The change list overflowed, assume the config was among them
+                on_change()
+                continue
+            changed = False
+            offset = 0
+            while True:
+                # FILE_NOTIFY_INFORMATION: NextEntryOffset, Action, FileNameLength, FileName
+                next_offset, _, length = struct.unpack_from("<III", buffer.raw, offset)
+                name = buffer.raw[offset + 12:offset + 12 + length].decode("utf-16-le")
+                changed = changed or name.lower() == file_name.lower()
+                if not next_offset:
+                    break
+                offset += next_offset
+            if changed:
+                on_change()
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+# Seconds the file has to stay quiet before a change is reloaded
+_RELOAD_DEBOUNCE = 0.5
+
+
+def _file_state(stat):
+    # The size and inode catch a file swapped in with the same mtime
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
 def setup_config_watcher():
     """Set up a file watcher to automatically reload config when it changes"""
-    import threading
-    import time
-    import os
-    from src.logger import actionLogger as logger
-
-    config_last_modified = os.path.getmtime(config_file())
+    path = _config_path()
+    config_last_state = _file_state(_stat_config())
+    pending_lock = threading.Lock()
+    pending_reload = None
+
+    def schedule_reload():
+        # Editors save in several steps, so every new change restarts the wait
+        nonlocal pending_reload
+        with pending_lock:
+            if pending_reload is not None:
+                pending_reload.cancel()
+            pending_reload = threading.Timer(_RELOAD_DEBOUNCE, reload_config)
+            pending_reload.daemon = True
+            pending_reload.start()
 
     def watcher():
-        nonlocal config_last_modified
+        nonlocal config_last_state
+        _wait_for_changes(os.path.dirname(path), os.path.basename(path), schedule_reload)
+        # Polling fallback for when the folder can't be watched
         while True:
             try:
-                current_modified = os.path.getmtime(config_file())
-                if current_modified > config_last_modified:
-                    config_last_modified = current_modified
-                    reload_config()
+                stat = _stat_or_none(path)
+                if stat is not None:
+                    current_state = _file_state(stat)
+                    # Any difference counts, a replaced or clock-skewed file can have an older mtime
+                    if current_state != config_last_state:
+                        config_last_state = current_state
+                        schedule_reload()
             except Exception:
                 pass
             time.sleep(2)  # Check every 2 seconds
 
     def reload_config():
-        logger("Config file changed, reloading configuration")
+        # Our own writes are already reflected in the cache
+        stat = _stat_or_none(path)
+        if stat is not None and stat.st_mtime_ns == _cached_mtime:
+            return
+        action_logger("Config file changed, reloading configuration")
         validate_config()
 
         # Reset any cached config values here
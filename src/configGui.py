@@ -13,6 +13,7 @@ from src.config import (
     append_config,
     remove_config,
     document_folder,
+    read_config_text,
     script_folder
 )
 from src.logger import actionLogger
@@ -164,11 +165,11 @@ class UI(PyQt5.QtWidgets.QMainWindow):
         """Save changes to the config file and refresh UI"""
         toWrite = str(self.configFileBrowser.toPlainText())
         try:
-            with open(config_file(), "r") as cfg:
-                current = cfg.read()
+            path = config_file()
+            current = read_config_text()
 
             if toWrite != current:
-                with open(config_file(), "w") as cfg:
+                with open(path, "w", encoding="utf-8") as cfg:
                     cfg.write(toWrite)
                 from src.pop import infoMessage, icons
                 infoMessage(
@@ -196,21 +197,24 @@ class UI(PyQt5.QtWidgets.QMainWindow):
     def refreshFile(self):
         """Refresh the config file display and update UI elements"""
         try:
-            with open(config_file(), "r") as cfg:
-                current_content = cfg.read()
-                # Always update the text browser to show current content
-                self.configFileBrowser.setText(current_content)
-                # Only trigger UI updates if content has actually changed
-                if current_content != self.last_config_content:
-                    self.last_config_content = current_content
-                    # Update UI elements based on current config
-                    self.updateUIFromConfig()
-                    actionLogger("Config file content changed, updating UI")
+            current_content = read_config_text()
+            # Always update the text browser to show current content
+            self.configFileBrowser.setText(current_content)
+            # Only trigger UI updates if content has actually changed
+            if current_content != self.last_config_content:
+                self.last_config_content = current_content
+                # Update UI elements based on current config
+                self.updateUIFromConfig()
+                actionLogger("Config file content changed, updating UI")
         except Exception as e:
             actionLogger(f"Error refreshing config file: {e}")
 
     def updateUIFromConfig(self):
         """Update all UI elements to match current config values"""
+        # Keep the values cached by cmdWorker in sync with the file
+        from src.cmdWorker import reload_settings
+        reload_settings()
+
         # Update checkbox states
         self.recursiveCheckbox.setChecked(
             get_config("FILETYPE", "recursive") == "True")
@@ -516,11 +520,10 @@ class UI(PyQt5.QtWidgets.QMainWindow):
     def checkConfigChanges(self):
         """Check if the config file has changed and update UI if needed"""
         try:
-            with open(config_file(), "r") as cfg:
-                current_content = cfg.read()
-                if current_content != self.last_config_content:
-                    self.last_config_content = current_content
-                    self.refreshFile()
+            current_content = read_config_text()
+            if current_content != self.last_config_content:
+                self.last_config_content = current_content
+                self.refreshFile()
         except Exception as e:
             actionLogger(f"Error checking config changes: {e}")
 
@@ -619,7 +622,7 @@ class UI(PyQt5.QtWidgets.QMainWindow):
                         "Shell handler has already been created", message, icon)
             return False
 
-        src.shellHandler.createInternetAccessMenu()
+        src.shellHandler.createInternetAccessMenu(force=True)
         icon = icons("info")
         infoMessage("Shell handler successfully created.", "Successfully added",
                     "You may now see the PyWall when right-clicking a file or a folder.", icon)
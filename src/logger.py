@@ -1,6 +1,7 @@
 """Logging module for PyWall."""
 
 import logging
+import logging.handlers
 import os
 from src.logging_utils import (
     action_logger,
@@ -25,6 +26,22 @@ logStandardException = log_standard_exception
 enableLogging = enable_logging
 
 
+# Action logs are buffered in memory and written in bulk, flushed when the buffer fills,
+# on errors and by logging's own shutdown hook when the process exits
+_actionFileLogger = logging.getLogger("PyWall.actions")
+_actionFileLogger.propagate = False
+_actionFileLogger.setLevel(logging.INFO)
+
+
+def _getActionFileLogger():
+    if not _actionFileLogger.handlers:
+        target = logging.FileHandler('logger.log', mode='a', delay=True)
+        target.setFormatter(logging.Formatter('%(message)s'))
+        _actionFileLogger.addHandler(logging.handlers.MemoryHandler(
+            capacity=256, flushLevel=logging.ERROR, target=target))
+    return _actionFileLogger
+
+
 def actionLogger(actionLogged):
     """Log an action to console and optionally to a file"""
     # This ought to fix all errors caused by not unicode characters...hopefully #
@@ -35,8 +52,7 @@ def actionLogger(actionLogged):
 
     try:
         if get_config("DEBUG", "create_logs") == "True":
-            with open('logger.log', 'a') as log:
-                log.write(actionLogged + '\n')
+            _getActionFileLogger().info(str(actionLogged))
     except Exception as Argument:
         print(
             "Something went really wrong, due to this incident no logs have been created, see full traceback: "
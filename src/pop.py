@@ -5,9 +5,8 @@ Notification and message display functionality for PyWall.
 import os
 import sys
 
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QMessageBox, QApplication
-from windows_toasts import ToastDuration
+# PyQt5 and windows_toasts are imported where they're used, so context menu
+# invocations that only show a toast don't pay for loading Qt
 
 from src.config import get_config
 from src.logger import actionLogger
@@ -23,6 +22,7 @@ if os.path.exists(possible_icon):
 
 def icons(icon_type="info"):
     """Get the appropriate icon for message boxes"""
+    from PyQt5.QtWidgets import QMessageBox
     icon_type.lower()
     if icon_type == "info":
         return QMessageBox.Information
@@ -33,6 +33,7 @@ def icons(icon_type="info"):
     elif icon_type == "question":
         return QMessageBox.Question
     elif icon_type == "pywall":
+        from PyQt5.QtGui import QIcon
         pywall = QIcon(icon_path)
         return pywall
     else:
@@ -44,6 +45,7 @@ def infoMessage(title, subtitle, message, icon=None):
     if get_config("UI", "show_notifications") != "True":
         return
 
+    from PyQt5.QtWidgets import QMessageBox, QApplication
     app = QApplication.instance()
     if not app:
         app = QApplication(sys.argv)
@@ -68,6 +70,7 @@ def confirmDialog(title, message, icon=None):
     if get_config("UI", "confirmation_dialog") != "True":
         return True
 
+    from PyQt5.QtWidgets import QMessageBox, QApplication
     app = QApplication.instance()
     if not app:
         app = QApplication(sys.argv)
@@ -91,7 +94,7 @@ def toastNotification(title, message):
     if get_config("UI", "show_notifications") != "True":
         return
     try:
-        from windows_toasts import WindowsToaster, Toast, ToastDisplayImage
+        from windows_toasts import WindowsToaster, Toast, ToastDisplayImage, ToastDuration
         toaster = WindowsToaster('PyWall')
         new_toast = Toast()
         new_toast.text_fields = [title, message]
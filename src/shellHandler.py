@@ -1,11 +1,14 @@
+import hashlib
 import os
-import pathlib
+import re
 import subprocess
 import sys  # Added missing sys import at the module level
+from functools import lru_cache
 
-from context_menu import menus
+if sys.platform == "win32":
+    import winreg
 
-from src.config import document_folder
+from src.config import default_config, document_folder
 from src.pop import toastNotification
 
 
@@ -13,6 +16,7 @@ from src.pop import toastNotification
 # this means duping already existing code :(
 
 
+@lru_cache(maxsize=1)
 def getScriptFolder():
     document_folder_path = str(document_folder())
     return document_folder_path + "\\PyWall\\Executable.txt"
@@ -24,14 +28,16 @@ def pop(title, text, close: bool):
 
 
 # The "open" command is repeated because I'm too lazy to define it and then just call it later, code redundancy go brr #
+# Plain strings, callers only need the path itself and an isfile check #
 def pyWallPath(folder):
-    return pathlib.Path(str(folder) + "/PyWall.exe")
+    return os.path.join(str(folder), "PyWall.exe")
 
 
 def pyWallScript(folder):
-    return pathlib.Path(str(folder) + "/main.py")
+    return os.path.join(str(folder), "main.py")
 
 
+@lru_cache(maxsize=1)
 def getFolder():
     try:
         with open(getScriptFolder(), 'r') as sf:
@@ -42,63 +48,101 @@ def getFolder():
             "Could not find PyWall, please open the program and try again.", True)
 
 
-def allowAccess(filenames, params):
+def _invalidate():
+    # Executable.txt changed, read it again on the next lookup
+    getFolder.cache_clear()
+    getScriptFolder.cache_clear()
+
+
+# PyWall.exe is built with --uac-admin, CreateProcess refuses it with this error instead of prompting
+ERROR_ELEVATION_REQUIRED = 740
+
+
+# ShellExecuteW show command, the elevated PyWall runs without a window like the direct launch #
+SW_SHOWNORMAL = 1
+
+
+def _runElevated(argv, folder):
+    import ctypes
+    result = ctypes.windll.shell32.ShellExecuteW(
+        None, "runas", argv[0], subprocess.list2cmdline(argv[1:]), str(folder), SW_SHOWNORMAL)
+    # Anything up to 32 is an error code, e.g. the UAC prompt was cancelled #
+    if result <= 32:
+        pop("PyWall could not be started",
+            f"Elevating PyWall failed (error {result}), the firewall rule was not changed.", True)
+
+
+def _accessAction(filenames, params, allow: bool):
     folder = getFolder()
     try:
-        if pyWallPath(folder).is_file() or pyWallScript(folder).is_file():
-            subprocess.call(
-                f'cmd /c cd "{folder}" && PyWall.exe -file "{filenames}" -allow true -rule_type {params}', shell=True)
-            # input() #
-            subprocess.call(
-                f'cmd /c cd "{folder}" && python "{folder}\\main.py" -file "{filenames}" -allow true -rule_type {params}', shell=True)
-            # input() #
+        # One stat when PyWall.exe is there, main.py is only checked when running from source
+        exe_path = pyWallPath(folder)
+        if os.path.isfile(exe_path):
+            argv = [exe_path]
         else:
-            os.remove(getScriptFolder())
+            script_path = pyWallScript(folder)
+            if not os.path.isfile(script_path):
+                os.remove(getScriptFolder())
+                _invalidate()
+                pop("PyWall.exe not found",
+                    "Could not find PyWall, please open the program and try again.", True)
+                return
+            argv = [sys.executable, script_path]
+        argv += ["-file", str(filenames), "-allow", "true" if allow else "false", "-rule_type", str(params)]
+        # No cmd.exe in between, the arguments go straight to PyWall without shell quoting
+        # Nothing waits on PyWall, the menu click returns right away and no console flashes up
+        try:
+            subprocess.Popen(argv, cwd=folder, close_fds=False,
+                             creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+        except OSError as e:
+            if getattr(e, "winerror", None) != ERROR_ELEVATION_REQUIRED:
+                raise
+            _runElevated(argv, folder)
+    except (OSError, subprocess.SubprocessError) as e:
+        if isinstance(e, FileNotFoundError):
             pop("PyWall.exe not found",
                 "Could not find PyWall, please open the program and try again.", True)
-    except FileNotFoundError:
-        pop("PyWall.exe not found",
-            "Could not find PyWall, please open the program and try again.", True)
+        else:
+            pop(f"PyWall error ({type(e).__name__})", str(e), True)
+
+
+# context_menu registers handlers by function name, so these stay real functions instead of partials #
+def allowAccess(filenames, params):
+    _accessAction(filenames, params, True)
 
 
 def denyAccess(filenames, params):
-    folder = getFolder()
-    try:
-        if pyWallPath(folder).is_file() or pyWallScript(folder).is_file():
-            subprocess.call(
-                f'cmd /c cd "{folder}" && PyWall.exe -file "{filenames}" -allow false -rule_type {params}', shell=True)
-            # input() #
-            subprocess.call(
-                f'cmd /c cd "{folder}" && python "{folder}\\main.py" -file "{filenames}" -allow false -rule_type {params}', shell=True)
-            # input() #
-        else:
-            os.remove(getScriptFolder())
-            pop("PyWall.exe not found",
-                "Could not find PyWall, please open the program and try again.", True)
-    except FileNotFoundError:
-        pop("PyWall.exe not found",
-            "Could not find PyWall, please open the program and try again.", True)
+    _accessAction(filenames, params, False)
 
 
 # This creates the context menu, It is important to do this for FILES and for DIRECTORY so that the user can right #
 # click on either. The keys created are in "HKEY_CURRENT_USER\Software\Classes\*\shell\" for FILES and in #
 # "HKEY_CURRENT_USER\Software\Classes\Directory\shell" for DIRECTORY #
 
-def createInternetAccessMenu():
+def createInternetAccessMenu(force=False):
+    # compile() rewrites every key, so an install that is already in place is skipped as a whole #
+    # An explicit install passes force, it also repairs menus whose marker still matches #
+    marker = _registryMarker()
+    if not force and _menuUpToDate(marker):
+        return
+
+    from context_menu import menus
+    # Both roots share the same submenus, assembled first and then compiled one after the other #
+    IAM_ALLOW, IAM_DENY = _sharedSubmenus()
     IAM = menus.ContextMenu('PyWall', type='FILES')
-    IAM_ALLOW = createAllowMenu()
-    IAM_DENY = createDenyMenu()
     IAM.add_items([IAM_ALLOW, IAM_DENY])
-    IAM.compile()
-
     IAM_Folder = menus.ContextMenu('PyWall', type='DIRECTORY')
     IAM_Folder.add_items([IAM_ALLOW, IAM_DENY])
+
+    IAM.compile()
     IAM_Folder.compile()
 
-    updateRegistry()
+    if updateRegistry():
+        _writeRegistryMarker(marker)
 
 
 def createAllowMenu():
+    from context_menu import menus
     IAM_ALLOW = menus.ContextMenu('Allow Internet Access')
     IAM_ALLOW.add_items([
         menus.ContextCommand("Allow inbound connections",
@@ -112,6 +156,7 @@ def createAllowMenu():
 
 
 def createDenyMenu():
+    from context_menu import menus
     IAM_DENY = menus.ContextMenu('Deny Internet Access')
     IAM_DENY.add_items([
         menus.ContextCommand("Deny inbound connections",
@@ -124,80 +169,146 @@ def createDenyMenu():
     return IAM_DENY
 
 
-def updateRegistry():
-    import winreg
-    # Command registry #
-    # Yes, this was just as tedious as you think it was #
-    FILES_ALLOW_BOTH = r"Software\Classes\*\shell\PyWall\shell\Allow Internet Access\shell\Allow inbound " \
-                       r"and outbound connections\command"
-    FILES_ALLOW_IN = r"Software\Classes\*\shell\PyWall\shell\Allow Internet Access\shell\Allow inbound " \
-                     r"connections\command"
-    FILES_ALLOW_OUT = r"Software\Classes\*\shell\PyWall\shell\Allow Internet Access\shell\Allow outbound " \
-                      r"connections\command"
-    FILES_DENY_BOTH = r"Software\Classes\*\shell\PyWall\shell\Deny Internet Access\shell\Deny inbound " \
-                      r"and outbound connections\command"
-    FILES_DENY_IN = r"Software\Classes\*\shell\PyWall\shell\Deny Internet Access\shell\Deny inbound " \
-                    r"connections\command"
-    FILES_DENY_OUT = r"Software\Classes\*\shell\PyWall\shell\Deny Internet Access\shell\Deny outbound " \
-                     r"connections\command"
-    # ---- #
-    DIR_ALLOW_BOTH = FILES_ALLOW_BOTH.replace("*", "Directory")
-    DIR_ALLOW_IN = FILES_ALLOW_IN.replace("*", "Directory")
-    DIR_ALLOW_OUT = FILES_ALLOW_OUT.replace("*", "Directory")
-    DIR_DENY_BOTH = FILES_DENY_BOTH.replace("*", "Directory")
-    DIR_DENY_IN = FILES_DENY_IN.replace("*", "Directory")
-    DIR_DENY_OUT = FILES_DENY_OUT.replace("*", "Directory")
+# The submenus hold no runtime state, so they are built once and shared. This happens on first use rather #
+# than on import, since every context menu click loads this module and never needs context_menu #
+@lru_cache(maxsize=1)
+def _sharedSubmenus():
+    return createAllowMenu(), createDenyMenu()
+
+
+# Icon registry, the PyWall menu for FILES and for DIRECTORY #
+PYWALL_REG_FILE = r"Software\Classes\*\shell\PyWall"
+PYWALL_REG_FOLDER = PYWALL_REG_FILE.replace("*", "Directory")
+
+# Command registry, relative to the "shell" key of each PyWall menu #
+# Yes, this was just as tedious as you think it was #
+MENU_PARENTS = (PYWALL_REG_FILE + r"\shell", PYWALL_REG_FOLDER + r"\shell")
+COMMAND_KEYS = (
+    r"Allow Internet Access\shell\Allow inbound and outbound connections\command",
+    r"Deny Internet Access\shell\Deny inbound and outbound connections\command",
+    r"Allow Internet Access\shell\Allow inbound connections\command",
+    r"Deny Internet Access\shell\Deny inbound connections\command",
+    r"Allow Internet Access\shell\Allow outbound connections\command",
+    r"Deny Internet Access\shell\Deny outbound connections\command"
+)
+
+# The argv plumbing context_menu wraps around the handler call, both pieces become commas #
+CMD_CLEAN_RE = re.compile(re.escape(r"([' '.join(sys.argv[1:]) ],'") + "|" + re.escape("')\""))
+
+# Hash of what the installed menu points to, stored once the install went through #
+MARKER_KEY = r"Software\PyWall"
+MARKER_VALUE = "RegistryMarker"
+
+
+def _registryMarker():
+    folder = getFolder()
+    icon_path = pyWallPath(folder) + ",0"
+    # The commands run sys.executable, a moved or upgraded interpreter needs new ones #
+    data = "\0".join((folder, icon_path, sys.executable, default_config["DEBUG"]["version"]))
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=8).hexdigest()
+
 
+def _menuUpToDate(marker):
     key = winreg.HKEY_CURRENT_USER
-    sub_keys = [
-        FILES_ALLOW_BOTH, FILES_DENY_BOTH, FILES_ALLOW_IN, FILES_DENY_IN, FILES_ALLOW_OUT, FILES_DENY_OUT,
-        DIR_ALLOW_BOTH, DIR_DENY_BOTH, DIR_ALLOW_IN, DIR_DENY_IN, DIR_ALLOW_OUT, DIR_DENY_OUT
-    ]
+    try:
+        with winreg.OpenKey(key, MARKER_KEY) as marker_key:
+            if winreg.QueryValueEx(marker_key, MARKER_VALUE)[0] != marker:
+                return False
+        # Menus or commands deleted by hand have to be installed again #
+        for parent in MENU_PARENTS:
+            with winreg.OpenKey(key, parent) as parent_key:
+                for command_key in COMMAND_KEYS:
+                    winreg.CloseKey(winreg.OpenKey(parent_key, command_key))
+    except OSError:
+        return False
+    return True
+
+
+def _writeRegistryMarker(marker):
+    try:
+        with winreg.CreateKey(winreg.HKEY_CURRENT_USER, MARKER_KEY) as marker_key:
+            winreg.SetValueEx(marker_key, MARKER_VALUE, 0, winreg.REG_SZ, marker)
+    except OSError as e:
+        print(f"Warning: Could not save registry marker: {e}")
 
-    # Icon registry #
-    PYWALL_REG_FILE = r"Software\Classes\*\shell\PyWall"
-    PYWALL_REG_FOLDER = r"Software\Classes\Directory\shell\PyWall"
+
+def _clearRegistryMarker():
+    try:
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, MARKER_KEY, 0, winreg.KEY_SET_VALUE) as marker_key:
+            winreg.DeleteValue(marker_key, MARKER_VALUE)
+    except OSError:
+        pass
+
+
+def updateRegistry():
+    key = winreg.HKEY_CURRENT_USER
 
     try:
         # This key will only work if run from an executable, and not if it is run from source #
         folder = getFolder()
-        try:
-            PYWALL_KEY = winreg.OpenKey(
-                key, PYWALL_REG_FILE, 0, winreg.KEY_ALL_ACCESS)
-            winreg.SetValueEx(PYWALL_KEY, 'Icon', 0, winreg.REG_SZ,
-                              str(pyWallPath(folder)) + ",0")
-            winreg.CloseKey(PYWALL_KEY)
-        except Exception as e:
-            print(f"Warning: Could not set file icon: {e}")
-
-        try:
-            PYWALL_FOLDER_KEY = winreg.OpenKey(
-                key, PYWALL_REG_FOLDER, 0, winreg.KEY_ALL_ACCESS)
-            winreg.SetValueEx(PYWALL_FOLDER_KEY, 'Icon', 0,
-                              winreg.REG_SZ, str(pyWallPath(folder)) + ",0")
-            winreg.CloseKey(PYWALL_FOLDER_KEY)
-        except Exception as e:
-            print(f"Warning: Could not set folder icon: {e}")
-
-        for x in sub_keys:
-            current_sub_key = winreg.QueryValue(key, x)
-            arg_index = winreg.QueryValue(key, x).index(" -c ")
-            current_sub_key = current_sub_key.replace(
-                r"([' '.join(sys.argv[1:]) ],'", ",").replace("')\"", ",")
-            # About the dumbest way to query for the third semicolon #
-            firstSemi = current_sub_key.find(";")
-            secondSemi = current_sub_key.find(";", firstSemi + 1)
-            thirdSemi = current_sub_key.find(";", secondSemi + 1)
-            # The context menu must be tested with a compiled version of PyWall, otherwise it won't work #
-            # PR's that address this are welcome #
-            replacement_sub_key = current_sub_key[:arg_index +
-                                                  4] + current_sub_key[thirdSemi + 1:]
-            winreg.SetValue(key, x, winreg.REG_SZ, replacement_sub_key)
+        icon_path = pyWallPath(folder) + ",0"
+        for reg_path, kind in ((PYWALL_REG_FILE, "file"), (PYWALL_REG_FOLDER, "folder")):
+            try:
+                with winreg.OpenKey(key, reg_path, 0, winreg.KEY_ALL_ACCESS) as PYWALL_KEY:
+                    # Only write when the icon actually changed #
+                    try:
+                        current_icon = winreg.QueryValueEx(PYWALL_KEY, 'Icon')[0]
+                    except FileNotFoundError:
+                        current_icon = None
+                    if current_icon != icon_path:
+                        winreg.SetValueEx(PYWALL_KEY, 'Icon', 0, winreg.REG_SZ, icon_path)
+            except Exception as e:
+                print(f"Warning: Could not set {kind} icon: {e}")
+
+        for parent in MENU_PARENTS:
+            # Open the menu once, the command keys below are resolved relative to it #
+            try:
+                parent_key = winreg.OpenKey(
+                    key, parent, 0, winreg.KEY_READ | winreg.KEY_WRITE)
+            except OSError as e:
+                print(f"Warning: Could not open {parent}: {e}")
+                continue
+            with parent_key:
+                updates = []
+                for x in COMMAND_KEYS:
+                    try:
+                        current_value = winreg.QueryValue(parent_key, x)
+                    except OSError:
+                        continue
+                    current_sub_key = current_value
+                    arg_index = current_sub_key.find(" -c ")
+                    if arg_index < 0:
+                        continue
+                    current_sub_key = CMD_CLEAN_RE.sub(",", current_sub_key)
+                    # About the dumbest way to query for the third semicolon #
+                    # A command without three of them was already rewritten or isn't ours #
+                    firstSemi = current_sub_key.find(";")
+                    if firstSemi < 0:
+                        continue
+                    secondSemi = current_sub_key.find(";", firstSemi + 1)
+                    if secondSemi < 0:
+                        continue
+                    thirdSemi = current_sub_key.find(";", secondSemi + 1)
+                    if thirdSemi < 0:
+                        continue
+                    # The context menu must be tested with a compiled version of PyWall, otherwise it won't work #
+                    # PR's that address this are welcome #
+                    replacement_sub_key = current_sub_key[:arg_index +
+                                                          4] + current_sub_key[thirdSemi + 1:]
+                    if replacement_sub_key != current_value:
+                        updates.append((x, replacement_sub_key))
+                # Everything is read before anything is written #
+                for x, replacement_sub_key in updates:
+                    winreg.SetValue(parent_key, x, winreg.REG_SZ, replacement_sub_key)
+        return True
 
     except Exception as e:
         print(f"Error updating registry: {e}")
+        return False
 
 
 def removeInternetAccessMenu():
+    from context_menu import menus
+    _clearRegistryMarker()
     menus.removeMenu('PyWall', type='FILES')
     menus.removeMenu("PyWall", type="DIRECTORY")